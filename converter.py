@@ -5,8 +5,43 @@ This module converts MIDI files to M1006 G-Code commands that can play music
 on Bambu Lab 3D printers using their built-in buzzer functionality.
 """
 
+import heapq
+import io
+from itertools import groupby
+from operator import itemgetter
+
 import mido
-from typing import List, Tuple
+import numpy as np
+from typing import List, TextIO, Tuple
+
+# Note events: start time and duration in seconds
+NOTE_DTYPE = np.dtype([('time', 'f8'), ('note', 'i1'), ('vel', 'i1'), ('dur', 'f8')])
+
+# M1006 command templates; only the duration (L) and the notes (C, E) vary
+_NOTE_TMPL = "M1006 A0 B10 L%d C%d D15 M75 E%d F10 N75"
+_REST_TMPL = "M1006 A0 B10 L%d C0 D15 M60 E0 F10 N60"
+
+_GCODE_HEADER = (
+    ";=====start printer sound ===================\n"
+    "M17\n"
+    "M400 S1\n"
+    "M1006 S1\n"
+    "\n"
+)
+
+_GCODE_FOOTER = (
+    "\n"
+    "M1006 W\n"
+    "M18\n"
+    ";=====end printer sound ===================\n"
+)
+
+# (duration_ms, C, E, is_rest)
+Command = Tuple[int, int, int, bool]
+
+# Note scoring scales for pitch/velocity and continuity
+_INV_127 = 1.0 / 127.0
+_INV_24 = 1.0 / 24.0
 
 
 def midi_to_gcode(midi_path: str, output_path: str = None, 
@@ -23,13 +58,16 @@ def midi_to_gcode(midi_path: str, output_path: str = None,
     
     # Apply tempo scaling
     if tempo_scale != 1.0:
-        notes = [(t / tempo_scale, n, v, d / tempo_scale) for t, n, v, d in notes]
+        notes['time'] /= tempo_scale
+        notes['dur'] /= tempo_scale
     
     # Generate G-Code commands
     gcode_lines = _notes_to_gcode(notes, max_polyphony, min_note_duration_ms, quantize_duration_ms)
     
     # Build final G-Code with header and footer
-    gcode = _build_gcode_file(gcode_lines)
+    buf = io.StringIO()
+    _build_gcode_file(buf, gcode_lines)
+    gcode = buf.getvalue()
     
     # Write to file if requested
     if output_path:
@@ -39,69 +77,60 @@ def midi_to_gcode(midi_path: str, output_path: str = None,
     return gcode
 
 
-def _extract_notes_from_midi(midi: mido.MidiFile) -> List[Tuple[float, int, int, float]]:
+def _extract_notes_from_midi(midi: mido.MidiFile) -> np.ndarray:
     """
     Extract note events from MIDI file with proper tempo handling.
     
     Returns:
-        List of (time_in_seconds, midi_note, velocity, duration_in_seconds) tuples
+        Structured array of NOTE_DTYPE (time, note, vel, dur) records,
+        sorted by start time
     """
     events = []
     
     # Process each track separately
-    for track_idx, track in enumerate(midi.tracks):
-        track_time_ticks = 0
+    for track in midi.tracks:
         track_time_seconds = 0.0
-        tempo = 500000  # Default tempo: 500,000 microseconds per beat (120 BPM)
+        # Default tempo: 500,000 microseconds per beat (120 BPM); seconds per
+        # tick uses the same scale as mido.tick2second
+        seconds_per_tick = 500000 * 1e-6 / midi.ticks_per_beat
         active_notes = {}  # {note_number: (start_time_seconds, velocity)}
         
         for msg in track:
-            # Accumulate ticks
-            track_time_ticks += msg.time
-            
             # Convert tick delta to seconds
-            tick_duration_seconds = mido.tick2second(
-                msg.time, midi.ticks_per_beat, tempo
-            )
-            track_time_seconds += tick_duration_seconds
+            track_time_seconds += msg.time * seconds_per_tick
+            msg_type = msg.type
             
-            # Handle tempo changes
-            if msg.type == 'set_tempo':
-                tempo = msg.tempo
-                
-            # Handle note on/off
-            if msg.type == 'note_on' and msg.velocity > 0:
-                # Note starts
+            # Handle note on/off and tempo changes
+            if msg_type == 'note_on' and msg.velocity > 0:
                 active_notes[msg.note] = (track_time_seconds, msg.velocity)
-                
-            elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                # Note ends
-                if msg.note in active_notes:
-                    start_time, velocity = active_notes.pop(msg.note)
-                    duration = track_time_seconds - start_time
-                    events.append((start_time, msg.note, velocity, duration))
+            elif msg_type == 'note_off' or msg_type == 'note_on':
+                started = active_notes.pop(msg.note, None)
+                if started is not None:
+                    events.append((started[0], msg.note, started[1],
+                                   track_time_seconds - started[0]))
+            elif msg_type == 'set_tempo':
+                seconds_per_tick = msg.tempo * 1e-6 / midi.ticks_per_beat
     
-    # Sort events by start time
-    events.sort(key=lambda x: x[0])
-    
-    return events
+    # Sort events by start time, ties keep track and note off order
+    events = np.array(events, dtype=NOTE_DTYPE)
+    return events[np.argsort(events['time'], kind='stable')]
 
 
-def _notes_to_gcode(events: List[Tuple], max_polyphony: int,
-                    min_duration_ms: int, quantize_duration_ms: int = None) -> List[str]:
+def _notes_to_gcode(events: np.ndarray, max_polyphony: int,
+                    min_duration_ms: int, quantize_duration_ms: int = None) -> List[Command]:
     """
     Convert note events to M1006 G-Code commands.
     
     Args:
-        events: List of (start_time, note, velocity, duration) tuples
+        events: Structured array of NOTE_DTYPE (time, note, vel, dur) records
         max_polyphony: Maximum simultaneous notes
         min_duration_ms: Minimum note duration
         quantize_duration_ms: If set, use this fixed duration for all notes
         
     Returns:
-        List of M1006 command strings
+        List of (duration_ms, C, E, is_rest) M1006 commands
     """
-    if not events:
+    if len(events) == 0:
         return []
     
     gcode_commands = []
@@ -135,24 +164,36 @@ def _notes_to_gcode(events: List[Tuple], max_polyphony: int,
     return _merge_adjacent_commands(gcode_commands)
 
 
-def _create_time_slices(events: List[Tuple], min_duration: float) -> List[Tuple]:
+def _create_time_slices(events: np.ndarray, min_duration: float) -> List[Tuple]:
     """
     Convert note events into time slices with active notes.
     
     Returns:
         List of (start_time, duration, [(note, velocity, note_start_time)]) tuples
     """
-    if not events:
+    if len(events) == 0:
         return []
     
-    # Create a timeline of all event changes
-    timeline = []
-    
-    for start_time, note, velocity, duration in events:
-        timeline.append((start_time, 'start', note, velocity))
-        timeline.append((start_time + duration, 'end', note, velocity))
+    # Starts are already in time order; ends need their own sort.
+    # Zero-length notes never sound and would otherwise end before they start
+    events = events[events['dur'] > 0]
+    starts = events[['time', 'note', 'vel']].tolist()
+    end_times = events['time'] + events['dur']
+    order = np.argsort(end_times, kind='stable')
+    ends = list(zip(end_times[order].tolist(),
+                    events['note'][order].tolist(),
+                    events['vel'][order].tolist()))
     
-    timeline.sort(key=lambda x: (x[0], x[1] == 'end'))  # ends before starts at same time
+    # Merge both into one timeline, ends before starts at same time
+    timeline = []
+    i = j = 0
+    while i < len(starts) or j < len(ends):
+        if i == len(starts) or (j < len(ends) and ends[j][0] <= starts[i][0]):
+            timeline.append((ends[j][0], 'end', ends[j][1], ends[j][2]))
+            j += 1
+        else:
+            timeline.append((starts[i][0], 'start', starts[i][1], starts[i][2]))
+            i += 1
     
     slices = []
     active_notes = {}  # note -> (velocity, start_time)
@@ -185,23 +226,32 @@ def _select_notes_for_slice(notes, prev_note, slice_time, max_polyphony,
     attacks = [t for t in notes if (slice_time - t[2]) <= attack_window]
 
     if attacks:
+        # Only the top max_polyphony scores are needed, not a sorted list
+        single = max_polyphony == 1
+        best = None
         scored = []
         for note, velocity, start_time in attacks:
             if prev_note is None:
                 continuity = 0.0
             else:
-                continuity = max(0.0, 1.0 - abs(note - prev_note) / 24.0)
+                continuity = max(0.0, 1.0 - abs(note - prev_note) * _INV_24)
 
             score = (
-                w_pitch * (note / 127.0) +
-                w_vel * (velocity / 127.0) +
+                w_pitch * (note * _INV_127) +
+                w_vel * (velocity * _INV_127) +
                 w_cont * continuity +
                 w_attack
             )
-            scored.append((score, note))
+            if single:
+                if best is None or (score, note) > best:
+                    best = (score, note)
+            else:
+                scored.append((score, note))
 
-        scored.sort(reverse=True)
-        chosen = [n for _, n in scored[:max_polyphony]]
+        if single:
+            chosen = [best[1]]
+        else:
+            chosen = [n for _, n in heapq.nlargest(max_polyphony, scored)]
         new_prev = chosen[0] if chosen else prev_note
         return chosen, new_prev
 
@@ -211,48 +261,17 @@ def _select_notes_for_slice(notes, prev_note, slice_time, max_polyphony,
     return [], prev_note
 
 
-def _merge_adjacent_commands(commands: List[str]) -> List[str]:
-    def parse(cmd: str):
-        parts = cmd.split()
-        if not parts or parts[0] != "M1006":
-            return None
-        params = {}
-        for part in parts[1:]:
-            if part:
-                params[part[0]] = int(part[1:])
-        return params
-
-    def build(params: dict) -> str:
-        order = ['A', 'B', 'L', 'C', 'D', 'M', 'E', 'F', 'N']
-        return "M1006 " + " ".join(f"{k}{params[k]}" for k in order)
-
-    merged = []
-    prev_params = None
-
-    for cmd in commands:
-        params = parse(cmd)
-        if params is None:
-            merged.append(cmd)
-            prev_params = None
-            continue
-
-        if prev_params is not None:
-            prev_cmp = dict(prev_params)
-            cur_cmp = dict(params)
-            prev_cmp.pop('L', None)
-            cur_cmp.pop('L', None)
-            if prev_cmp == cur_cmp:
-                prev_params['L'] += params.get('L', 0)
-                merged[-1] = build(prev_params)
-                continue
-
-        merged.append(cmd)
-        prev_params = params
-
-    return merged
-
-
-def _create_note_command(notes: List[int], duration_ms: int) -> str:
+def _merge_adjacent_commands(commands: List[Command]) -> List[Command]:
+    """
+    Coalesce runs of identical commands into one by summing their durations.
+    """
+    return [
+        (sum(cmd[0] for cmd in group), c, e, is_rest)
+        for (c, e, is_rest), group in groupby(commands, key=itemgetter(1, 2, 3))
+    ]
+
+
+def _create_note_command(notes: List[int], duration_ms: int) -> Command:
     """
     Create an M1006 command for playing notes.
     
@@ -260,66 +279,39 @@ def _create_note_command(notes: List[int], duration_ms: int) -> str:
     - C, E: MIDI note numbers for up to 2 voices
     - L: Duration in milliseconds
     - A, B, D, F, M, N: Sound shaping parameters
-    """
-    # Standard parameters for active notes
-    params = {
-        'A': 0,
-        'B': 10,
-        'L': duration_ms,
-        'D': 15,
-        'M': 75,
-        'F': 10,
-        'N': 75
-    }
     
-    # Assign notes to C and E parameters
-    if len(notes) >= 1:
-        params['C'] = notes[0]
-    else:
-        params['C'] = 0
-        
-    if len(notes) >= 2:
-        params['E'] = notes[1]
-    else:
-        params['E'] = notes[0] if notes else 0
-    
-    # Build command string
-    cmd = "M1006"
-    for key in ['A', 'B', 'L', 'C', 'D', 'M', 'E', 'F', 'N']:
-        cmd += f" {key}{params[key]}"
-    
-    return cmd
+    Only L, C and E vary, so the command is kept as a
+    (duration_ms, C, E, is_rest) tuple until _build_gcode_file.
+    """
+    c = notes[0] if notes else 0
+    e = notes[1] if len(notes) >= 2 else c
+    return (duration_ms, c, e, False)
 
 
-def _create_rest_command(duration_ms: int) -> str:
+def _create_rest_command(duration_ms: int) -> Command:
     """
     Create an M1006 command for a rest (silence).
     """
-    return f"M1006 A0 B10 L{duration_ms} C0 D15 M60 E0 F10 N60"
+    return (duration_ms, 0, 0, True)
 
 
-def _build_gcode_file(commands: List[str]) -> str:
+def _format_command(cmd: Command) -> str:
     """
-    Build the complete G-Code file with header and footer.
+    Serialize a (duration_ms, C, E, is_rest) command to an M1006 line.
     """
-    lines = [
-        ";=====start printer sound ===================",
-        "M17",
-        "M400 S1",
-        "M1006 S1",
-        ""
-    ]
-    
-    lines.extend(commands)
-    
-    lines.extend([
-        "",
-        "M1006 W",
-        "M18",
-        ";=====end printer sound ==================="
-    ])
-    
-    return '\n'.join(lines) + '\n'
+    duration_ms, c, e, is_rest = cmd
+    if is_rest:
+        return _REST_TMPL % duration_ms
+    return _NOTE_TMPL % (duration_ms, c, e)
+
+
+def _build_gcode_file(f: TextIO, commands: List[Command]) -> None:
+    """
+    Write the complete G-Code file with header and footer to f.
+    """
+    f.write(_GCODE_HEADER)
+    f.writelines(_format_command(cmd) + '\n' for cmd in commands)
+    f.write(_GCODE_FOOTER)
 
 
 def convert_midi_file(input_midi: str, output_gcode: str = None, **kwargs) -> str:
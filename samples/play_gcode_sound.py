@@ -1,8 +1,11 @@
+import mmap
+import os
 import re
 import sys
 import wave
 import numpy as np
 import sounddevice as sd
+from numba import njit
 
 # Config
 SAMPLE_RATE = 44100
@@ -11,51 +14,114 @@ INTER_CMD_GAP_MS = 8
 FADE_MS = 4
 OCTAVE_SHIFT = 12
 
-def midi_to_freq(midi_note: float) -> float:
+# Silence lengths in samples; the output buffer starts zeroed, so these
+# are only skipped over
+_INTER_GAP_SAMPLES = int(SAMPLE_RATE * (INTER_CMD_GAP_MS / 1000.0))
+_DRAIN_GAP_SAMPLES = int(0.02 * SAMPLE_RATE)
+
+_M1006_LINE = re.compile(rb"^[ \t]*(M1006 [^\r\n]*)", re.MULTILINE)
+
+# MIDI note (0..127) => Hz, 69 => 440 Hz (A4)
+_FREQ_LUT = (440.0 * np.power(2.0, (np.arange(128, dtype=np.float64) - 69.0) / 12.0)).astype(np.float32)
+
+
+def midi_to_freq(midi_note: int) -> float:
     """
     Interpret values like 48, 50, 53, 55 as MIDI notes.
     69 => 440 Hz (A4)
     """
-    midi_note = float(np.clip(midi_note + OCTAVE_SHIFT, 0, 127))
-    return 440.0 * (2.0 ** ((midi_note - 69.0) / 12.0))
+    return _FREQ_LUT[max(0, min(127, int(midi_note) + OCTAVE_SHIFT))]
 
 
-def stepperish_wave(freq: np.ndarray, t: np.ndarray) -> np.ndarray:
+@njit("void(float32, int64, int64, int64, float32, float32[::1])",
+      cache=True, fastmath=True)
+def stepperish_wave(freq_hz, n, sr, fade, amp, out):
     """
     Stepper motors don't sound like pure sine waves.
-    This approximates the buzzy tone with harmonics.
+    This approximates the buzzy tone with harmonics, applies the
+    fade in/out and the amplitude, and adds the result into out.
+
+    The pitch is constant, so each harmonic is advanced with the
+    recurrence sin((i+1)w) = 2cos(w)sin(iw) - sin((i-1)w) instead of
+    calling sin for every sample.
     """
-    x = np.sin(2 * np.pi * freq * t)
-    x += 0.45 * np.sin(2 * np.pi * (2 * freq) * t)
-    x += 0.20 * np.sin(2 * np.pi * (3 * freq) * t)
-    return x.astype(np.float32)
+    w = 2.0 * np.pi * freq_hz / sr
+    c1 = 2.0 * np.cos(w)
+    c2 = 2.0 * np.cos(2.0 * w)
+    c3 = 2.0 * np.cos(3.0 * w)
 
+    # (previous, current) sample of each harmonic, starting at i = 0
+    h1_prev, h1 = -np.sin(w), 0.0
+    h2_prev, h2 = -np.sin(2.0 * w), 0.0
+    h3_prev, h3 = -np.sin(3.0 * w), 0.0
 
-def synth_note(freq_hz: float, duration_ms: int, amp: float) -> np.ndarray:
+    ramp = max(fade - 1, 1)
+    for i in range(n):
+        x = h1 + 0.45 * h2 + 0.20 * h3
+
+        # Fade in/out
+        if i < fade:
+            x *= i / ramp
+        elif i >= n - fade:
+            x *= (n - 1 - i) / ramp
+
+        out[i] += x * amp
+
+        h1_prev, h1 = h1, c1 * h1 - h1_prev
+        h2_prev, h2 = h2, c2 * h2 - h2_prev
+        h3_prev, h3 = h3, c3 * h3 - h3_prev
+
+
+def note_samples(duration_ms: int) -> int:
     duration_s = max(0.001, duration_ms / 1000.0)
-    n = int(SAMPLE_RATE * duration_s)
-    t = np.linspace(0, duration_s, n, endpoint=False)
+    return int(SAMPLE_RATE * duration_s)
 
-    # Constant pitch note
-    freq = np.full_like(t, freq_hz, dtype=np.float32)
-    x = stepperish_wave(freq, t)
 
-    # Fade in/out
+def synth_note_into(out: np.ndarray, freq_hz: float, amp: float):
+    """
+    Add a constant pitch note spanning the whole of out into out.
+    """
+    n = len(out)
     fade = int((FADE_MS / 1000.0) * SAMPLE_RATE)
     fade = min(fade, n // 2)
-    if fade > 0:
-        env = np.ones(n, dtype=np.float32)
-        env[:fade] = np.linspace(0, 1, fade, dtype=np.float32)
-        env[-fade:] = np.linspace(1, 0, fade, dtype=np.float32)
-        x *= env
-
-    # Apply amplitude
-    x *= float(amp)
+    stepperish_wave(freq_hz, n, SAMPLE_RATE, fade, amp, out)
+
+
+def synth_note(freq_hz: float, duration_ms: int, amp: float) -> np.ndarray:
+    x = np.zeros(note_samples(duration_ms), dtype=np.float32)
+    synth_note_into(x, freq_hz, amp)
     return x
 
 
 def parse_params(line: str) -> dict[str, int]:
-    return {k: int(v) for k, v in re.findall(r"([A-Z])(-?\d+)", line)}
+    """
+    Parse the KEY<int> tokens following the command word, e.g.
+    "M1006 A0 B10 L120" => {"A": 0, "B": 10, "L": 120}.
+
+    A token is an uppercase letter, an optional "-" and digits only;
+    anything else is skipped.
+    """
+    params = {}
+    for p in line.split()[1:]:
+        key, value = p[0], p[1:]
+        digits = value[1:] if value.startswith("-") else value
+        if "A" <= key <= "Z" and digits.isascii() and digits.isdigit():
+            params[key] = int(value)
+    return params
+
+
+def iter_m1006_lines(path: str):
+    """
+    Yield every M1006 line of a G-code file, found with a single regex
+    scan over the memory-mapped file. Comments and other commands are
+    skipped by the scan itself.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return  # mmap can't map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for m in _M1006_LINE.finditer(mm):
+                yield m.group(1).decode("ascii", "ignore")
 
 
 def extract_voices(p: dict[str, int]):
@@ -84,77 +150,100 @@ def extract_voices(p: dict[str, int]):
     return L, notes, float(amp)
 
 
-def mix(segments: list[np.ndarray]) -> np.ndarray:
-    if not segments:
-        return np.zeros(0, dtype=np.float32)
-    out = np.zeros_like(segments[0], dtype=np.float32)
-    for s in segments:
-        out += s
-    out /= max(1, len(segments))  # prevent clipping when multiple voices
-    return out
+def to_int16(x: np.ndarray) -> np.ndarray:
+    return (np.clip(x, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def mix(out: np.ndarray, notes: list[int], amp: float,
+        note_cache: dict[tuple[int, int, int], np.ndarray]):
+    """
+    Write the average of every voice into the int16 slice out.
+
+    Repeated notes are common, so each (note, length, amplitude) voice
+    is synthesized once, scaled by MASTER_VOL, quantized to int16 and
+    reused from note_cache.
+    """
+    if not notes:
+        return
+    n_samples = len(out)
+    amp_key = int(amp * 255)
+    voices = []
+    for n in notes:
+        key = (n, n_samples, amp_key)
+        seg = note_cache.get(key)
+        if seg is None:
+            x = np.zeros(n_samples, dtype=np.float32)
+            synth_note_into(x, midi_to_freq(n), amp)
+            x *= MASTER_VOL
+            seg = to_int16(x)
+            note_cache[key] = seg
+        voices.append(seg)
+
+    if len(voices) == 1:
+        out[:] = voices[0]
+        return
+
+    # Accumulate in int32 so the sum can't overflow, then average
+    acc = np.zeros(n_samples, dtype=np.int32)
+    for seg in voices:
+        acc += seg
+    acc //= len(voices)  # prevent clipping when multiple voices
+    out[:] = acc
 
 
 def gcode_to_audio(path: str, verbose: bool = True) -> np.ndarray:
-    chunks = []
+    # Pass 1: parse commands into (n_samples, notes, amp) so the output
+    # buffer can be allocated once up front
+    commands = []
     idx = 0
 
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        for raw in f:
-            line = raw.strip()
-            if not line or line.startswith(";"):
-                continue
+    for line in iter_m1006_lines(path):
+        if line.startswith("M1006 W"):
+            # tiny drain pause
+            commands.append((_DRAIN_GAP_SAMPLES, [], 0.0))
+            continue
 
-            if line.startswith("M1006 W"):
-                # tiny drain pause
-                chunks.append(np.zeros(int(0.02 * SAMPLE_RATE), dtype=np.float32))
-                continue
+        p = parse_params(line)
 
-            if not line.startswith("M1006 "):
-                continue
+        # Skip M1006 S1 and similar non-note setup calls
+        if not any(k in p for k in ("A", "C", "E", "L")):
+            continue
 
-            p = parse_params(line)
+        L, notes, amp = extract_voices(p)
 
-            # Skip M1006 S1 and similar non-note setup calls
-            if not any(k in p for k in ("A", "C", "E", "L")):
-                continue
-
-            L, notes, amp = extract_voices(p)
+        if not notes:
+            # real rest
             n_samples = int(SAMPLE_RATE * (L / 1000.0))
+        else:
+            n_samples = note_samples(L)
+        commands.append((n_samples, notes, amp))
+
+        # add a small inter-command gap to restore “pauses”
+        commands.append((_INTER_GAP_SAMPLES, [], 0.0))
 
-            if not notes:
-                # real rest
-                seg = np.zeros(n_samples, dtype=np.float32)
-            else:
-                # synth each active voice as a constant-pitch note
-                voices = []
-                for n in notes:
-                    f_hz = midi_to_freq(n)
-                    voices.append(synth_note(f_hz, L, amp))
-                seg = mix(voices)
-
-            chunks.append(seg)
-
-            # add a small inter-command gap to restore “pauses”
-            gap = np.zeros(int(SAMPLE_RATE * (INTER_CMD_GAP_MS / 1000.0)), dtype=np.float32)
-            chunks.append(gap)
-
-            idx += 1
-            if verbose and idx <= 60:
-                # keep console sane: print first ~60 lines
-                note_str = ",".join(str(n) for n in notes) if notes else "REST"
-                print(f"{idx:03d}: L={L}ms notes={note_str} amp={amp:.2f}")
-
-    if not chunks:
+        idx += 1
+        if verbose and idx <= 60:
+            # keep console sane: print first ~60 lines
+            note_str = ",".join(str(n) for n in notes) if notes else "REST"
+            print(f"{idx:03d}: L={L}ms notes={note_str} amp={amp:.2f}")
+
+    if not commands:
         raise RuntimeError("No playable M1006 commands found. Check path / contents.")
 
-    audio = np.concatenate(chunks).astype(np.float32)
-    audio *= MASTER_VOL
-    audio = np.clip(audio, -1.0, 1.0)
+    # Pass 2: mix each active voice straight into its slice; rests and
+    # gaps are left as the zeros the buffer starts with
+    audio = np.zeros(sum(n for n, _, _ in commands), dtype=np.int16)
+    note_cache = {}
+    offset = 0
+    for n_samples, notes, amp in commands:
+        mix(audio[offset:offset + n_samples], notes, amp, note_cache)
+        offset += n_samples
+
     return audio
 
 
 def write_wav(path: str, audio: np.ndarray):
-    audio_i16 = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    audio_i16 = audio if audio.dtype == np.int16 else to_int16(audio)
     with wave.open(path, "wb") as wf:
         wf.setnchannels(1)
         wf.setsampwidth(2)
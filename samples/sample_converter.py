@@ -1,9 +1,21 @@
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + os.sep + "..")
 from converter import convert_midi_file
 
+def _convert_one(midi_file):
+    output = midi_file.replace("MIDI", "GCode").replace(".mid", ".gcode")
+    return convert_midi_file(
+        midi_file, 
+        output,
+        max_polyphony=1,
+        min_note_duration_ms=60,
+        quantize_duration_ms=None,
+        tempo_scale=1
+    )
+
 def main():
     print("=" * 70)
     print()
@@ -14,16 +26,10 @@ def main():
     for midi_file in midi_files:
         print(f"Input MIDI file: {midi_file}")
         print()
-        
-        output = midi_file.replace("MIDI", "GCode").replace(".mid", ".gcode")
-        gcode = convert_midi_file(
-            midi_file, 
-            output,
-            max_polyphony=1,
-            min_note_duration_ms=60,
-            quantize_duration_ms=None,
-            tempo_scale=1
-        )
+    
+    # Each conversion is CPU-bound Python, so run them in separate processes
+    with ProcessPoolExecutor() as ex:
+        list(ex.map(_convert_one, midi_files))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()